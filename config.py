@@ -1,16 +1,25 @@
+import functools
 import os
-import json
 from dotenv import load_dotenv
 
-# Load env from local file or secrets path
-if os.path.exists(".env"):
-    load_dotenv(".env")
-elif os.path.exists("/secrets/.env"):
-    load_dotenv("/secrets/.env")
+# orjson is much faster for any JSON we parse; fall back to the stdlib if it isn't installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Load env from local file or secrets path (real environment variables win)
+ENV_PATH = next((p for p in (".env", "/secrets/.env") if os.path.isfile(p)), None)
+if ENV_PATH:
+    load_dotenv(ENV_PATH)
 
 # Telegram Config
 TOKEN = os.getenv("TOKEN")
-ADMIN_IDS = json.loads(os.getenv("ADMIN_IDS", "[]"))
+
+@functools.cache
+def admin_ids() -> frozenset[int]:
+    """Admin Telegram IDs, parsed from ADMIN_IDS on first use rather than at import."""
+    return frozenset(json_loads(os.getenv("ADMIN_IDS", "[]")))
 
 # Supabase Config
 SUPABASE_URL = os.getenv("SUPABASE_URL")
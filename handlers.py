@@ -1,47 +1,103 @@
+import asyncio
 import datetime
+import hashlib
+import heapq
+import itertools
 import logging
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
 from io import BytesIO
+from pathlib import Path
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import ContextTypes, Application
-from telegram.error import BadRequest
+from telegram.error import BadRequest, TelegramError
 import matplotlib
 matplotlib.use('Agg')  # Non-GUI backend for server
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
 import numpy as np
+from PIL import Image
+from cachetools import TTLCache, LRUCache
 import services
 
 # Setup logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_UTC = datetime.timezone.utc
+
+# Registered profiles rarely change, so keep them in-process to skip a Supabase round-trip per update
+_USER_CACHE: TTLCache[int, services.UserInfo] = TTLCache(maxsize=4096, ttl=300)
+
+# Selection grids keyed by (level, statuses in grid slot order); a grid only changes when a status does
+_LEVEL_MENU_CACHE: LRUCache[tuple, InlineKeyboardMarkup] = LRUCache(maxsize=64)
+
+# Hash of the last content safe_edit_message put on each (chat_id, message_id)
+_LAST_EDIT: LRUCache[tuple[int, int], int] = LRUCache(maxsize=2048)
+
+# Rate limits. Recent complaints/pings are remembered in-process so repeats are rejected without
+# a DB query; entries expire with their window. The DB stays the source of truth after a restart.
+PING_COOLDOWN = 200  # seconds between pings for the same machine
+COMPLAINT_WINDOW = 3600  # one complaint per user per machine per hour (see services.can_submit_complaint)
+_RECENT_PINGS: TTLCache[str, float] = TTLCache(maxsize=256, ttl=PING_COOLDOWN)
+_RECENT_COMPLAINTS: TTLCache[tuple[int, str], float] = TTLCache(maxsize=4096, ttl=COMPLAINT_WINDOW)
+
 # --- HELPERS ---
-def format_time_delta(end_dt: datetime.datetime):
+async def _can_submit_complaint(user_id: int, mid: str) -> bool:
+    """Rejects in-process when this user already reported the machine; otherwise asks the DB."""
+    if (user_id, mid) in _RECENT_COMPLAINTS:
+        return False
+    return await services.run_db(services.can_submit_complaint, user_id, mid)
+
+async def _get_user_cached(user_id: int):
+    """Returns the user's profile, hitting Supabase only on a cache miss."""
+    db_user = _USER_CACHE.get(user_id)
+    if db_user is None:
+        db_user = await services.run_db(services.get_user, user_id)
+        if db_user:
+            _USER_CACHE[user_id] = db_user
+    return db_user
+
+def format_time_delta(end_dt: datetime.datetime, now_ts: float = None):
+    """Whole minutes between end_dt and now (either direction). now_ts is a POSIX timestamp."""
     if not end_dt: return 0
-    now = datetime.datetime.now(datetime.timezone.utc)
-    diff = now - end_dt if now > end_dt else end_dt - now
-    return int(diff.total_seconds() / 60)
+    if now_ts is None:
+        now_ts = time.time()
+    return int(abs(now_ts - end_dt.timestamp()) // 60)
 
+@lru_cache(maxsize=128)
 def format_machine_name(mid: str):
     """Converts '17_dryer_1' to 'Lvl17 Dryer 1' for display."""
-    try:
-        parts = mid.split('_') 
-        if len(parts) >= 3:
-            level = parts[0]
-            mtype = parts[1].capitalize()
-            idx = parts[2]
-            return f"Lvl{level} {mtype} {idx}"
-        return mid
-    except:
-        return mid
+    parts = mid.split('_')
+    if len(parts) >= 3:
+        return f"Lvl{parts[0]} {parts[1].capitalize()} {parts[2]}"
+    return mid
+
+# Markdown escapes applied in a single str.translate pass
+_MD_TRANS = str.maketrans({"\\": "\\\\", "_": "\\_", "*": "\\*", "`": "\\`", "[": "\\["})
+_MD_CHARS = frozenset("\\_*`[")
 
+# The same few user names/houses are rendered over and over, so escaped forms are memoized
+@lru_cache(maxsize=2048)
 def escape_md(text: str) -> str:
     """Helper to escape Markdown special chars."""
     if not text: return ""
-    escaped = str(text).replace("\\", "\\\\")
-    return escaped.replace("_", "\\_").replace("*", "\\*").replace("`", "\\`").replace("[", "\\[")
+    s = str(text)
+    return s.translate(_MD_TRANS) if not _MD_CHARS.isdisjoint(s) else s
 
 async def safe_edit_message(message, text, reply_markup=None, parse_mode="Markdown"):
     """Safely edits a message, ignoring 'Message is not modified' errors."""
+    # Skip the round-trip entirely when we already put exactly this content on the message
+    key = (message.chat_id, message.message_id)
+    content = hash((text, reply_markup, parse_mode))
+    if _LAST_EDIT.get(key) == content:
+        return
     try:
         await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
     except BadRequest as e:
@@ -49,6 +105,9 @@ async def safe_edit_message(message, text, reply_markup=None, parse_mode="Markdo
             pass # Ignore legitimate no-op edits
         else:
             raise e # Raise other real errors
+    _LAST_EDIT[key] = content
+
+BOT_COMMANDS_HASH_FILE = ".botcmd_hash"
 
 async def set_bot_commands(application):
     commands = [
@@ -59,32 +118,45 @@ async def set_bot_commands(application):
         BotCommand("stats", "View Usage Patterns"),
         BotCommand("help", "Show Help")
     ]
+
+    # Only hit the Bot API when the command list (or the bot it goes to) differs from what we last pushed
+    payload = repr((application.bot.id, [(c.command, c.description) for c in commands])).encode()
+    digest = hashlib.blake2b(payload, digest_size=8).hexdigest()
+    try:
+        with open(BOT_COMMANDS_HASH_FILE, "r", encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                return
+    except OSError:
+        pass
+
     await application.bot.set_my_commands(commands)
+    try:
+        with open(BOT_COMMANDS_HASH_FILE, "w", encoding="utf-8") as f:
+            f.write(digest)
+    except OSError as e:
+        logger.warning(f"⚠️ Could not save bot command hash: {e}")
 
-# --- NOTIFICATION JOBS ---
-async def alarm_5min(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    mid = job.data.get('mid')
+# --- NOTIFICATIONS ---
+async def send_5min_alert(bot, chat_id: int, mid: str):
     display_name = format_machine_name(mid)
     try:
-        print(f"⏰ Executing 5-min alarm for {mid}")
-        await context.bot.send_message(
-            chat_id=job.chat_id, 
+        logger.debug("⏰ Executing 5-min alarm for %s", mid)
+        await bot.send_message(
+            chat_id=chat_id, 
             text=f"⏳ *5 Minutes Left!*\nYour laundry in *{display_name}* is almost ready.",
             parse_mode="Markdown"
         )
     except Exception as e:
         logger.error(f"❌ Failed to send 5-min alarm: {e}")
 
-async def alarm_done(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    mid = job.data.get('mid')
+async def send_done_alert(bot, chat_id: int, mid: str):
+    """Sends the 'Laundry Done' DM; used by the timer loop and for cycles that ended while the bot was down."""
     display_name = format_machine_name(mid)
     try:
-        print(f"✅ Executing DONE alarm for {mid}")
+        logger.debug("✅ Executing DONE alarm for %s", mid)
         kb = [[InlineKeyboardButton("✅ I collected my laundry", callback_data=f"collect_{mid}")]]
-        await context.bot.send_message(
-            chat_id=job.chat_id, 
+        await bot.send_message(
+            chat_id=chat_id, 
             text=f"✅ *Laundry Done!*\nYour machine *{display_name}* is finished.\nPlease collect it immediately!",
             parse_mode="Markdown",
             reply_markup=InlineKeyboardMarkup(kb)
@@ -92,63 +164,115 @@ async def alarm_done(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"❌ Failed to send DONE alarm: {e}")
 
+# --- TIMERS ---
+# Every pending alarm sits in one heap of (due timestamp, seq, alert, mid, chat_id, generation)
+# served by run_timer_loop. Re-arming or cancelling a machine's alarms bumps its generation,
+# so superseded entries are simply skipped when they reach the top of the heap.
+_TIMERS: list[tuple[float, int, object, str, int, int]] = []
+_TIMER_GEN: defaultdict[str, int] = defaultdict(int)
+_TIMER_SEQ = itertools.count()  # tie-breaker so the heap never compares the alert functions
+_TIMER_WAKE = asyncio.Event()
+
+def schedule_alarms(mid: str, chat_id: int, end_ts: float):
+    """(Re)arms the done alarm, and the 5-minute warning if there is time for one, for a machine."""
+    cancel_alarms(mid)
+    gen = _TIMER_GEN[mid]
+    if end_ts - time.time() > 300:
+        heapq.heappush(_TIMERS, (end_ts - 300, next(_TIMER_SEQ), send_5min_alert, mid, chat_id, gen))
+    heapq.heappush(_TIMERS, (end_ts, next(_TIMER_SEQ), send_done_alert, mid, chat_id, gen))
+    _TIMER_WAKE.set()
+
+def cancel_alarms(mid: str):
+    _TIMER_GEN[mid] += 1
+
+async def run_timer_loop(bot):
+    """Sleeps until the earliest alarm is due, fires everything that is due, repeats forever."""
+    while True:
+        _TIMER_WAKE.clear()
+        now = time.time()
+        while _TIMERS and _TIMERS[0][0] <= now:
+            _, _, alert, mid, chat_id, gen = heapq.heappop(_TIMERS)
+            if gen == _TIMER_GEN[mid]:
+                await alert(bot, chat_id, mid)
+
+        timeout = _TIMERS[0][0] - time.time() if _TIMERS else None
+        try:
+            await asyncio.wait_for(_TIMER_WAKE.wait(), timeout)
+        except TimeoutError:
+            pass
+
 # --- RESTORE TIMERS ---
 async def restore_timers(application: Application):
-    print("🔄 Hydrating Timers from Supabase...")
-    if not application.job_queue:
-        print("❌ CRITICAL: Job Queue is NOT available. Notifications will fail.")
-        return
-
+    logger.info("🔄 Hydrating Timers from Supabase...")
     try:
-        running_machines = services.get_running_machines()
+        running_machines = await services.run_db(services.get_running_machines)
     except Exception as e:
-        print(f"❌ Database Error during hydration: {e}")
+        logger.error(f"❌ Database Error during hydration: {e}")
         return
 
     count = 0
-    now = datetime.datetime.now(datetime.timezone.utc)
+    now_ts = time.time()
+    overdue = []
     
-    print(f"📄 Found {len(running_machines)} machines marked as 'Running' in DB.")
+    logger.info(f"📄 Found {len(running_machines)} machines marked as 'Running' in DB.")
 
     for m in running_machines:
         if not m.end_time or not m.current_user: continue
         
-        delay = (m.end_time - now).total_seconds()
+        end_ts = m.end_time.timestamp()
         user_id = m.current_user.id
         mid = m.id
         
-        if delay > 0:
-            application.job_queue.run_once(alarm_done, delay, chat_id=user_id, data={"mid": mid}, name=f"done_{mid}")
-            if delay > 300:
-                application.job_queue.run_once(alarm_5min, delay - 300, chat_id=user_id, data={"mid": mid}, name=f"5min_{mid}")
-            count += 1
+        if end_ts > now_ts:
+            schedule_alarms(mid, user_id, end_ts)
         else:
-            application.job_queue.run_once(alarm_done, 1, chat_id=user_id, data={"mid": mid}, name=f"done_{mid}")
-            count += 1
+            # Finished while we were down: alert now rather than queueing an alarm
+            overdue.append(send_done_alert(application.bot, user_id, mid))
+        count += 1
+
+    if overdue:
+        await asyncio.gather(*overdue)
             
-    print(f"✅ Successfully restored {count} active timers.")
+    logger.info(f"✅ Successfully restored {count} active timers.")
 
 # --- COMMANDS ---
-try:
-    with open("bot_help.md", "r", encoding="utf-8") as f:
-        HELP_TEXT = f.read()
-except FileNotFoundError:
-    HELP_TEXT = "Help file not found."
+HELP_PATH = Path("bot_help.md")
+
+@lru_cache(maxsize=1)
+def _read_help() -> str:
+    """Reads bot_help.md on the first /help; a missing file raises, so it is retried next time."""
+    return HELP_PATH.read_text(encoding="utf-8")
+
+def get_help_text() -> str:
+    try:
+        return _read_help()
+    except FileNotFoundError:
+        return "Help file not found."
+
+# Static replies, built once at import
+REGISTER_FIRST_TEXT = "⚠️ Please /register first."
+WELCOME_TEXT = ("👋 *Welcome to the Hostel Laundry Bot!*\n\n"
+                "I am here to help you track washer/dryer availability and set timers.\n\n"
+                "To get started, I just need a few details.")
+ASK_NAME_TEXT = "*1. What is your Name?* (Please type it below)"
+UPDATE_PROFILE_TEXT = "🔄 *Update Profile*\n\nLet's update your details.\n\n" + ASK_NAME_TEXT
+NOT_ENOUGH_DATA_TEXT = ("📊 *Not enough data yet!*\n\n"
+                        "We need more usage history to generate meaningful stats.\n"
+                        "Check back in a few days after more people use the bot.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(HELP_TEXT, parse_mode="Markdown")
+    await update.message.reply_text(get_help_text(), parse_mode="Markdown")
 
 async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db_user = services.get_user(user.id)
+    db_user = await _get_user_cached(user.id)
     args = context.args
 
     if not db_user:
         # New user - start registration
-        context.user_data["registration"] = {"step": "NAME", "pending_machine": args[0] if args else None}
-        intro_text = "👋 *Welcome to the Hostel Laundry Bot!*\n\nI am here to help you track washer/dryer availability and set timers.\n\nTo get started, I just need a few details."
-        await update.message.reply_text(intro_text, parse_mode="Markdown")
-        await update.message.reply_text("*1. What is your Name?* (Please type it below)", parse_mode="Markdown")
+        context.user_data["registration"] = Registration(pending_machine=args[0] if args else None)
+        await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown")
+        await update.message.reply_text(ASK_NAME_TEXT, parse_mode="Markdown")
         return
 
     if args:
@@ -156,40 +280,37 @@ async def register_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Existing user - start profile update flow
-    context.user_data["registration"] = {"step": "NAME", "pending_machine": None}
-    await update.message.reply_text(
-        "🔄 *Update Profile*\n\nLet's update your details.\n\n*1. What is your Name?* (Please type it below)",
-        parse_mode="Markdown"
-    )
+    context.user_data["registration"] = Registration()
+    await update.message.reply_text(UPDATE_PROFILE_TEXT, parse_mode="Markdown")
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db_user = services.get_user(user.id)
+    db_user = await _get_user_cached(user.id)
     if not db_user:
-        await update.message.reply_text("⚠️ Please /register first.")
+        await update.message.reply_text(REGISTER_FIRST_TEXT)
         return
     await send_level_selection_menu(update, context, db_user.level)
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db_user = services.get_user(user.id)
+    db_user = await _get_user_cached(user.id)
     level_to_show = db_user.level if db_user else "9"
-    machines = services.get_machines_by_level(level_to_show)
+    machines = await services.get_machines_by_level_async(level_to_show)
     await send_status_text(update, context, machines, level_to_show)
 
 async def complain_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Report a machine discrepancy (machine in use but shown as available)."""
     user = update.effective_user
-    db_user = services.get_user(user.id)
+    db_user = await _get_user_cached(user.id)
     if not db_user:
-        await update.message.reply_text("⚠️ Please /register first.")
+        await update.message.reply_text(REGISTER_FIRST_TEXT)
         return
     await send_complain_menu(update, context, db_user.level)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show laundry usage statistics with visualizations."""
     user = update.effective_user
-    db_user = services.get_user(user.id)
+    db_user = await _get_user_cached(user.id)
     if not db_user:
         await update.message.reply_text("⚠️ Please /register first to see stats for your level.")
         return
@@ -197,42 +318,27 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     level = db_user.level
     await update.message.reply_text(f"📊 Generating laundry statistics for Level {level}...")
 
-    usage_data = services.get_hourly_usage_data(level, days_back=30)
+    histogram = await services.run_db(services.get_usage_histogram, level, days_back=30)
 
-    if len(usage_data) < 10:
-        await update.message.reply_text(
-            "📊 *Not enough data yet!*\n\n"
-            "We need more usage history to generate meaningful stats.\n"
-            "Check back in a few days after more people use the bot.",
-            parse_mode="Markdown"
-        )
+    # Both charts and the summary read from the same 7x24 (days x hours) grid
+    grid = _usage_grid(histogram)
+    total_cycles = int(grid.sum())
+    if total_cycles < 10:
+        await update.message.reply_text(NOT_ENOUGH_DATA_TEXT, parse_mode="Markdown")
         return
 
-    # Generate and send heatmap
-    heatmap_buf = generate_heatmap(usage_data, level)
-    await update.message.reply_photo(
-        photo=heatmap_buf,
-        caption=f"🗓️ *Laundry Heatmap - Level {level}*\nDarker = Busier. Find the light spots for free machines!",
-        parse_mode="Markdown"
-    )
+    hourly_counts = grid.sum(axis=0)
+    days_count = max(histogram[0]["active_days"], 1)  # Avoid division by zero
 
-    # Generate and send hourly bar chart
-    bar_buf = generate_hourly_bar_chart(usage_data)
-    await update.message.reply_photo(
-        photo=bar_buf,
-        caption="⏰ *Best Times to Do Laundry*\nGreen = Low traffic, Red = Avoid if possible",
-        parse_mode="Markdown"
-    )
+    # Render both charts off the event loop (the figure lock serializes them), then
+    # upload them concurrently; the summary follows so it lands below the charts
+    heatmap_buf = await asyncio.to_thread(generate_heatmap, grid / days_count, level)
+    bar_buf = await asyncio.to_thread(generate_hourly_bar_chart, hourly_counts)
 
     # Text summary
-    hourly_counts = [0] * 24
-    for event in usage_data:
-        hourly_counts[event["hour_of_day"]] += 1
-
-    total_cycles = len(usage_data)
-    busiest_hour = max(range(24), key=lambda h: hourly_counts[h])
+    busiest_hour = int(np.argmax(hourly_counts))
     # Find quietest hour between 6am-11pm (reasonable laundry hours)
-    quietest_hour = min(range(6, 23), key=lambda h: hourly_counts[h])
+    quietest_hour = int(np.argmin(hourly_counts[6:23])) + 6
 
     summary = (
         f"📈 *Quick Stats (Last 30 Days) - Level {level}*\n\n"
@@ -241,35 +347,64 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Quietest hour: {quietest_hour}:00\n\n"
         f"💡 *Tip*: Try doing laundry around {quietest_hour}:00 for shorter waits!"
     )
+    await asyncio.gather(
+        update.message.reply_photo(
+            photo=heatmap_buf,
+            caption=f"🗓️ *Laundry Heatmap - Level {level}*\nDarker = Busier. Find the light spots for free machines!",
+            parse_mode="Markdown"
+        ),
+        update.message.reply_photo(
+            photo=bar_buf,
+            caption="⏰ *Best Times to Do Laundry*\nGreen = Low traffic, Red = Avoid if possible",
+            parse_mode="Markdown"
+        ),
+    )
     await update.message.reply_text(summary, parse_mode="Markdown")
 
 # --- GRAPH GENERATION ---
-def generate_heatmap(usage_data, level):
-    """Generate a heatmap of usage by day and hour."""
-    # Initialize 7x24 grid (days x hours)
-    heatmap = np.zeros((7, 24))
-
-    for event in usage_data:
-        day = event["day_of_week"]
-        hour = event["hour_of_day"]
-        heatmap[day][hour] += 1
-
-    # Calculate number of unique days in dataset
-    unique_dates = set()
-    for event in usage_data:
-        if 'created_at' in event:
-            unique_dates.add(event['created_at'][:10])  # Extract date part (YYYY-MM-DD)
+# Figures are built once and redrawn for every /stats call; matplotlib isn't thread-safe, so renders are serialized
+_CHART_LOCK = threading.Lock()
+_HEATMAP_FIG = Figure(figsize=(9, 4), dpi=100, layout="constrained")
+FigureCanvasAgg(_HEATMAP_FIG)
+_HEATMAP_AX, _HEATMAP_CAX = _HEATMAP_FIG.subplots(1, 2, gridspec_kw={"width_ratios": (40, 1)})
+# One colorbar, repointed at each render's image: a fresh colorbar on the same axes chains onto
+# the previous one's hooks and keeps every earlier colorbar and image alive
+_HEATMAP_CBAR = _HEATMAP_FIG.colorbar(ScalarMappable(cmap='YlOrRd'), cax=_HEATMAP_CAX)
+_BAR_FIG = Figure(figsize=(9, 4), dpi=100, layout="constrained")
+FigureCanvasAgg(_BAR_FIG)
+_BAR_AX = _BAR_FIG.subplots()
+# Flat-colour charts barely shrink under heavier zlib levels, so favour encode speed
+_PNG_OPTS = {"compress_level": 1, "optimize": False}
+BAR_PALETTE = np.array(['#2ecc71', '#f1c40f', '#e74c3c'])  # low, medium, high traffic
+
+def _encode_png(fig):
+    """Rasterizes a pooled figure and PNG-encodes its RGBA buffer straight through Pillow."""
+    fig.canvas.draw()
+    img = Image.frombuffer("RGBA", fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
+    buf = BytesIO()
+    img.save(buf, format="PNG", **_PNG_OPTS)
+    buf.seek(0)
+    return buf
 
-    days_count = max(len(unique_dates), 1)  # Avoid division by zero
+def _usage_grid(histogram):
+    """Scatters the (day_of_week, hour_of_day, cycles) histogram rows into a 7x24 grid."""
+    grid = np.zeros((7, 24), dtype=np.int64)
+    for row in histogram:
+        grid[row["day_of_week"], row["hour_of_day"]] = row["cycles"]
+    return grid
 
-    # Convert to daily averages
-    heatmap = heatmap / days_count
+def generate_heatmap(grid, level):
+    """Generate a heatmap of usage by day and hour from a 7x24 grid of daily averages."""
+    # Only show relevant hours (6am - 11pm)
+    heatmap_trimmed = grid[:, 6:24]
 
-    # Create figure
-    fig, ax = plt.subplots(figsize=(12, 5))
+    with _CHART_LOCK:
+        return _render_heatmap(heatmap_trimmed, level)
 
-    # Only show relevant hours (6am - 11pm)
-    heatmap_trimmed = heatmap[:, 6:24]
+def _render_heatmap(heatmap_trimmed, level):
+    """Draws onto the pooled heatmap figure; caller holds _CHART_LOCK."""
+    fig, ax, cbar = _HEATMAP_FIG, _HEATMAP_AX, _HEATMAP_CBAR
+    ax.cla()
 
     # Set vmin and vmax to actual data range for proper color scaling
     vmax = heatmap_trimmed.max()
@@ -288,44 +423,31 @@ def generate_heatmap(usage_data, level):
     ax.set_ylabel('Day of Week')
     ax.set_title(f'Laundry Usage Patterns - Level {level} (Last 30 Days)')
 
-    # Add colorbar with decimal ticks
-    cbar = plt.colorbar(im, ax=ax)
+    # Add colorbar with up to 6 rounded ticks (daily averages are fractional, so not integer-only)
+    cbar.update_normal(im)
+    cbar.locator = MaxNLocator(nbins=6)
     cbar.set_label('Average Cycles Per Day')
 
-    # Set appropriate ticks on colorbar
-    if vmax > 0:
-        # For decimal values, use up to 6 tick marks
-        tick_values = np.linspace(0, vmax, min(6, int(vmax * 2) + 1))
-        cbar.set_ticks(tick_values)
-        cbar.set_ticklabels([f'{v:.1f}' for v in tick_values])
-
-    plt.tight_layout()
-
-    # Save to BytesIO
-    buf = BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-    buf.seek(0)
-    plt.close(fig)
-
-    return buf
+    # Encode to an in-memory PNG
+    return _encode_png(fig)
 
-def generate_hourly_bar_chart(usage_data):
-    """Generate bar chart showing busiest hours."""
-    hourly_counts = [0] * 24
-    for event in usage_data:
-        hourly_counts[event["hour_of_day"]] += 1
+def generate_hourly_bar_chart(hourly_counts):
+    """Generate bar chart showing busiest hours from 24 per-hour cycle counts."""
+    with _CHART_LOCK:
+        return _render_hourly_bar_chart(hourly_counts)
 
-    fig, ax = plt.subplots(figsize=(10, 4))
+def _render_hourly_bar_chart(hourly_counts):
+    """Draws onto the pooled bar chart figure; caller holds _CHART_LOCK."""
+    fig, ax = _BAR_FIG, _BAR_AX
+    ax.cla()
 
     hours = range(24)
 
-    # Color based on percentile
-    if max(hourly_counts) > 0:
-        p33 = np.percentile([c for c in hourly_counts if c > 0], 33) if any(hourly_counts) else 1
-        p66 = np.percentile([c for c in hourly_counts if c > 0], 66) if any(hourly_counts) else 2
-        colors = ['#2ecc71' if c <= p33 else '#f1c40f' if c <= p66 else '#e74c3c' for c in hourly_counts]
-    else:
-        colors = ['#2ecc71'] * 24
+    # Color based on percentile of the non-zero hours: <= p33 green, <= p66 yellow, else red
+    counts = np.asarray(hourly_counts)
+    nonzero = counts[counts > 0]
+    p33, p66 = np.percentile(nonzero, [33, 66]) if nonzero.size else (0, 0)
+    colors = BAR_PALETTE[(counts > p33).astype(np.intp) + (counts > p66)].tolist()
 
     ax.bar(hours, hourly_counts, color=colors)
     ax.set_xlabel('Hour of Day')
@@ -343,42 +465,84 @@ def generate_hourly_bar_chart(usage_data):
     ]
     ax.legend(handles=legend_elements, loc='upper right')
 
-    plt.tight_layout()
+    return _encode_png(fig)
 
-    buf = BytesIO()
-    plt.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-    buf.seek(0)
-    plt.close(fig)
+# --- MENUS ---
+# (label, machine type, first index, stop index) for each row of the machine grid
+MACHINE_GRID = (("W", "washer", 1, 4), ("W", "washer", 4, 6), ("D", "dryer", 1, 3), ("D", "dryer", 3, 5))
+STATUS_ICONS = {"Running": "❌ ", "Finished": "⚠️ "}
+
+# Static navigation rows shared by every render
+LEVEL_NAV_ROW = (
+    InlineKeyboardButton("Lvl 9", callback_data="view_lvl_9"),
+    InlineKeyboardButton("Lvl 17", callback_data="view_lvl_17"),
+)
+# Complaint menu "switch level" button, keyed by the level currently shown
+COMPLAIN_NAV_ROWS = {
+    level: (InlineKeyboardButton(f"🔄 Switch to Level {other}", callback_data=f"complain_lvl_{other}"),)
+    for level, other in (("9", "17"), ("17", "9"))
+}
+
+# Menu texts, keyed by level; other levels are formatted on demand
+LEGEND = "✅ Available  ❌ Running  ⚠️ Finished"
+MENU_HEADER = "👇 *Select Machine (Level {level})*\n\n" + LEGEND
+COMPLAIN_HEADER = ("⚠️ *Report Machine Discrepancy (Level {level})*\n\n"
+                   "Select the machine that is IN USE but shown as available/finished.\n\n" + LEGEND)
+MENU_HEADERS = {level: MENU_HEADER.format(level=level) for level in ("9", "17")}
+COMPLAIN_HEADERS = {level: COMPLAIN_HEADER.format(level=level) for level in ("9", "17")}
+
+def _build_grid_slots(level: str) -> dict[str, int]:
+    """Numbers the grid's machine ids in reading order."""
+    ids = (f"{level}_{kind}_{i}" for _, kind, start, stop in MACHINE_GRID for i in range(start, stop))
+    return {mid: slot for slot, mid in enumerate(ids)}
+
+def _build_menu_layout(prefix: str, level: str):
+    """Grid rows of (slot, callback_data, short label); only the status icons vary per request."""
+    slots = _grid_slots(level)
+    return tuple(
+        tuple((slots[f"{level}_{kind}_{i}"], f"{prefix}{level}_{kind}_{i}", f"{short}{i}") for i in range(start, stop))
+        for short, kind, start, stop in MACHINE_GRID
+    )
 
-    return buf
+# Only the real levels are memoized; the level comes from callback data, so anything else is built on the fly
+_GRID_SLOTS = {level: _build_grid_slots(level) for level in ("9", "17")}
+
+def _grid_slots(level: str) -> dict[str, int]:
+    return _GRID_SLOTS.get(level) or _build_grid_slots(level)
+
+_MENU_LAYOUT = {(prefix, level): _build_menu_layout(prefix, level)
+                for prefix in ("sel_", "complain_sel_") for level in ("9", "17")}
+
+def _menu_layout(prefix: str, level: str):
+    return _MENU_LAYOUT.get((prefix, level)) or _build_menu_layout(prefix, level)
+
+def _grid_statuses(level: str, machines) -> tuple[str, ...]:
+    """Machine statuses in grid slot order; machines missing from the DB read as Available."""
+    slots = _grid_slots(level)
+    statuses = ["Available"] * len(slots)
+    for m in machines:
+        slot = slots.get(m.id)
+        if slot is not None:
+            statuses[slot] = m.status
+    return tuple(statuses)
+
+def _machine_grid(prefix: str, level: str, statuses: tuple[str, ...]):
+    """Builds the machine button rows with a status icon on each label."""
+    return [
+        [InlineKeyboardButton(STATUS_ICONS.get(statuses[slot], "✅ ") + label, callback_data=data)
+         for slot, data, label in row]
+        for row in _menu_layout(prefix, level)
+    ]
 
-# --- MENUS ---
 async def send_level_selection_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, level: str):
-    machines = services.get_machines_by_level(level)
-    status_map = {m.id: m.status for m in machines}
-
-    def get_btn_text(type_short, type_key, index):
-        mid = f"{level}_{type_key}_{index}"
-        status = status_map.get(mid, "Available")
-        if status == "Running": return f"❌ {type_short}{index}"
-        elif status == "Finished": return f"⚠️ {type_short}{index}"
-        else: return f"✅ {type_short}{index}"
-
-    keyboard = []
-    row1 = [InlineKeyboardButton(get_btn_text("W", "washer", i), callback_data=f"sel_{level}_washer_{i}") for i in range(1, 4)]
-    row2 = [InlineKeyboardButton(get_btn_text("W", "washer", i), callback_data=f"sel_{level}_washer_{i}") for i in range(4, 6)]
-    row3 = [InlineKeyboardButton(get_btn_text("D", "dryer", i), callback_data=f"sel_{level}_dryer_{i}") for i in range(1, 3)]
-    row4 = [InlineKeyboardButton(get_btn_text("D", "dryer", i), callback_data=f"sel_{level}_dryer_{i}") for i in range(3, 5)]
-    keyboard.extend([row1, row2, row3, row4])
-
-    nav_row = [
-        InlineKeyboardButton("Lvl 9", callback_data="view_lvl_9"),
-        InlineKeyboardButton("Lvl 17", callback_data="view_lvl_17"),
-    ]
-    keyboard.append(nav_row)
+    statuses = _grid_statuses(level, await services.get_machines_by_level_async(level))
+    cache_key = (level, statuses)
+    markup = _LEVEL_MENU_CACHE.get(cache_key)
+    if markup is None:
+        markup = InlineKeyboardMarkup(_machine_grid("sel_", level, statuses) + [LEVEL_NAV_ROW])
+        _LEVEL_MENU_CACHE[cache_key] = markup
 
-    text = f"👇 *Select Machine (Level {level})*\n\n✅ Available  ❌ Running  ⚠️ Finished"
-    markup = InlineKeyboardMarkup(keyboard)
+    text = MENU_HEADERS.get(level) or MENU_HEADER.format(level=level)
 
     if update.callback_query:
         await safe_edit_message(update.callback_query.message, text, reply_markup=markup)
@@ -387,31 +551,11 @@ async def send_level_selection_menu(update: Update, context: ContextTypes.DEFAUL
 
 async def send_complain_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, level: str):
     """Show machine grid for reporting discrepancies."""
-    machines = services.get_machines_by_level(level)
-    status_map = {m.id: m.status for m in machines}
-
-    def get_btn_text(type_short, type_key, index):
-        mid = f"{level}_{type_key}_{index}"
-        status = status_map.get(mid, "Available")
-        if status == "Running": return f"❌ {type_short}{index}"
-        elif status == "Finished": return f"⚠️ {type_short}{index}"
-        else: return f"✅ {type_short}{index}"
-
-    keyboard = []
-    row1 = [InlineKeyboardButton(get_btn_text("W", "washer", i), callback_data=f"complain_sel_{level}_washer_{i}") for i in range(1, 4)]
-    row2 = [InlineKeyboardButton(get_btn_text("W", "washer", i), callback_data=f"complain_sel_{level}_washer_{i}") for i in range(4, 6)]
-    row3 = [InlineKeyboardButton(get_btn_text("D", "dryer", i), callback_data=f"complain_sel_{level}_dryer_{i}") for i in range(1, 3)]
-    row4 = [InlineKeyboardButton(get_btn_text("D", "dryer", i), callback_data=f"complain_sel_{level}_dryer_{i}") for i in range(3, 5)]
-    keyboard.extend([row1, row2, row3, row4])
-
-    # Switch level button
-    other_level = "17" if level == "9" else "9"
-    nav_row = [InlineKeyboardButton(f"🔄 Switch to Level {other_level}", callback_data=f"complain_lvl_{other_level}")]
-    keyboard.append(nav_row)
-
-    text = (f"⚠️ *Report Machine Discrepancy (Level {level})*\n\n"
-            f"Select the machine that is IN USE but shown as available/finished.\n\n"
-            f"✅ Available  ❌ Running  ⚠️ Finished")
+    statuses = _grid_statuses(level, await services.get_machines_by_level_async(level))
+    keyboard = _machine_grid("complain_sel_", level, statuses)
+    keyboard.append(COMPLAIN_NAV_ROWS.get(level, COMPLAIN_NAV_ROWS["17"]))  # any other level switches to 9
+
+    text = COMPLAIN_HEADERS.get(level) or COMPLAIN_HEADER.format(level=level)
     markup = InlineKeyboardMarkup(keyboard)
 
     if update.callback_query:
@@ -419,17 +563,20 @@ async def send_complain_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
     else:
         await update.message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
 
-async def show_machine_control_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, machine_id: str, ping_status=None):
-    machine = services.get_machine(machine_id)
+async def show_machine_control_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, machine_id: str, ping_status=None, *, machine=None):
+    # Callers that already hold the row pass it in to skip the fetch
+    if machine is None:
+        machine = await services.get_machine_async(machine_id)
     if not machine:
         await context.bot.send_message(update.effective_chat.id, "❌ Machine not found.")
         return
 
-    now = datetime.datetime.now(datetime.timezone.utc)
+    now = datetime.datetime.now(_UTC)
+    now_ts = now.timestamp()
     display_name = format_machine_name(machine.id)
     
     if machine.status == 'Running' and machine.end_time and machine.end_time > now:
-        mins_left = format_time_delta(machine.end_time)
+        mins_left = format_time_delta(machine.end_time, now_ts)
         current_user = update.effective_user
 
         # Check if the viewer is the owner of the machine
@@ -465,23 +612,23 @@ async def show_machine_control_panel(update: Update, context: ContextTypes.DEFAU
         kb = [[InlineKeyboardButton("35 Mins", callback_data=f"set_{machine_id}_35"),
                InlineKeyboardButton("70 Mins", callback_data=f"set_{machine_id}_70")]]
     
-    prev_msg = ""
+    # Title, spacer, optional "Ready" line, prompt (and ping status) joined once at the end
+    lines = [f"⚙️ *{display_name}*", ""]
     if machine.status == 'Finished':
         if machine.end_time:
-            ago = format_time_delta(machine.end_time)
+            ago = format_time_delta(machine.end_time, now_ts)
             prev_user_raw = machine.last_user.display_name if machine.last_user else "Unknown"
             prev_user = escape_md(prev_user_raw)
-            prev_msg = f"\n(Ready {ago}m ago. Last: {prev_user})"
+            lines.append(f"(Ready {ago}m ago. Last: {prev_user})")
             
             if machine.last_user:
                 last_time = machine.last_ping
-                now_utc = datetime.datetime.now(datetime.timezone.utc)
                 
                 ping_btn_text = "🔔 Ping Owner (Hurry up!)"
                 callback = f"ping_{machine_id}"
                 
-                if last_time and (now_utc - last_time).total_seconds() < 200:
-                    remaining = 200 - int((now_utc - last_time).total_seconds())
+                if last_time and now_ts - last_time.timestamp() < PING_COOLDOWN:
+                    remaining = PING_COOLDOWN - int(now_ts - last_time.timestamp())
                     ping_btn_text = f"⏳ Wait {remaining}s to Ping"
                     callback = "ignore_ping" 
                     
@@ -493,10 +640,10 @@ async def show_machine_control_panel(update: Update, context: ContextTypes.DEFAU
 
     kb.append([InlineKeyboardButton("🔙 Cancel", callback_data=f"view_lvl_{machine.level}")])
 
-    msg = f"⚙️ *{display_name}*\n{prev_msg}\nSelect duration:"
-    
+    lines.append("Select duration:")
     if ping_status:
-        msg += f"\n\n{ping_status}"
+        lines.extend(("", ping_status))
+    msg = "\n".join(lines)
 
     if update.callback_query:
         await safe_edit_message(update.callback_query.message, msg, reply_markup=InlineKeyboardMarkup(kb))
@@ -504,24 +651,39 @@ async def show_machine_control_panel(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
 
 # --- REGISTRATION LOGIC ---
+@dataclass(slots=True)
+class Registration:
+    """Per-user onboarding state kept in context.user_data["registration"]."""
+    step: str = "NAME"
+    name: str = ""
+    level: str = ""
+    pending_machine: Optional[str] = None
+
+REG_LEVEL_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Level 9", callback_data="reg_lvl_9"),
+                                          InlineKeyboardButton("Level 17", callback_data="reg_lvl_17")]])
+
 async def handle_registration_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reg_data = context.user_data.get("registration")
-    if not reg_data or reg_data["step"] != "NAME": return
+    if not reg_data or reg_data.step != "NAME": return
 
-    reg_data["name"] = update.message.text.strip()
-    reg_data["step"] = "LEVEL"
+    reg_data.name = update.message.text.strip()
+    reg_data.step = "LEVEL"
     
-    kb = [[InlineKeyboardButton("Level 9", callback_data="reg_lvl_9"),
-           InlineKeyboardButton("Level 17", callback_data="reg_lvl_17")]]
-    
-    name_clean = escape_md(reg_data['name'])
-    await update.message.reply_text(f"Hi {name_clean}! Which laundry room level do you use?", reply_markup=InlineKeyboardMarkup(kb))
+    name_clean = escape_md(reg_data.name)
+    await update.message.reply_text(f"Hi {name_clean}! Which laundry room level do you use?", reply_markup=REG_LEVEL_MARKUP)
 
 # --- STATUS LOGIC ---
+STATUS_SEPARATOR = "------------------\n"
+STATUS_HEADER = "📊 *Laundry Status (Level {level})*\n\n"
+STATUS_HEADERS = {level: STATUS_HEADER.format(level=level) for level in ("9", "17")}
+
 async def send_status_text(update: Update, context: ContextTypes.DEFAULT_TYPE, machines, level):
-    response = f"📊 *Laundry Status (Level {level})*\n\n"
-    washers = [m for m in machines if m.type == 'Washer']
-    dryers = [m for m in machines if m.type == 'Dryer']
+    parts: list[str] = [STATUS_HEADERS.get(level) or STATUS_HEADER.format(level=level)]
+    now_ts = time.time()
+    washers, dryers = [], []
+    for m in machines:
+        if m.type == 'Washer': washers.append(m)
+        elif m.type == 'Dryer': dryers.append(m)
     
     def format_line(m):
         icon = "✅"
@@ -530,7 +692,7 @@ async def send_status_text(update: Update, context: ContextTypes.DEFAULT_TYPE, m
         name = format_machine_name(m.id)
         
         if m.status == 'Running':
-            left = format_time_delta(m.end_time)
+            left = format_time_delta(m.end_time, now_ts)
             icon = "❌"
             status = f"Running ({left}m left)"
             if m.current_user: 
@@ -538,19 +700,20 @@ async def send_status_text(update: Update, context: ContextTypes.DEFAULT_TYPE, m
                 user_info = f"   └ {clean_name}"
             
         elif m.status == 'Finished':
-            ago = format_time_delta(m.end_time)
+            ago = format_time_delta(m.end_time, now_ts)
             icon = "⚠️"
             status = f"Ready ({ago}m ago)"
             if m.last_user: 
                 clean_name = escape_md(m.last_user.display_name)
                 user_info = f"   └ {clean_name}"
             
-        return f"{icon} *{name}*: {status}\n{user_info}"
+        return f"{icon} *{name}*: {status}\n{user_info}\n"
+
+    parts.extend(format_line(w) for w in washers)
+    parts.append(STATUS_SEPARATOR)
+    parts.extend(format_line(d) for d in dryers)
+    response = "".join(parts)
 
-    for w in washers: response += format_line(w) + "\n"
-    response += "------------------\n"
-    for d in dryers: response += format_line(d) + "\n"
-    
     kb = [[InlineKeyboardButton("Switch Level View", callback_data="toggle_status_level")]]
     
     if update.callback_query:
@@ -559,248 +722,322 @@ async def send_status_text(update: Update, context: ContextTypes.DEFAULT_TYPE, m
         await update.message.reply_text(response, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
 
 # --- BUTTON HANDLER ---
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    user = update.effective_user
-
-    if data == "ignore_ping":
-        await query.answer("⏳ Please wait for the cooldown.", show_alert=True)
-        return
+# Keyboards that never change, built once at import
+HOUSE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(h, callback_data=f"reg_house_{h}") for h in ("Zenith", "Nous", "Aeon")]])
+STATUS_LEVEL_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(l, callback_data=f"status_view_{l}") for l in ("9", "17")]])
 
-    # REGISTRATION
-    if data.startswith("reg_lvl_"):
-        lvl = data.split("_")[-1]
-        context.user_data["registration"]["level"] = lvl
-        keyboard = [
-            [InlineKeyboardButton("Zenith", callback_data="reg_house_Zenith"),
-             InlineKeyboardButton("Nous", callback_data="reg_house_Nous"),
-             InlineKeyboardButton("Aeon", callback_data="reg_house_Aeon")]
-        ]
-        await safe_edit_message(query.message, "Select House:", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+async def _handle_ignore_ping(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    await update.callback_query.answer("⏳ Please wait for the cooldown.", show_alert=True)
 
-    if data.startswith("reg_house_"):
-        house = data.split("_")[-1]
-        reg = context.user_data["registration"]
-        new_user = services.UserInfo(
-            id=user.id, username=user.username or "", first_name=user.first_name or "",
-            display_name=reg["name"], level=reg["level"], house=house
-        )
-        services.create_user(new_user)
-        await safe_edit_message(query.message, "✅ Registered! Type /start to begin.")
-        del context.user_data["registration"]
-        return
+# REGISTRATION
+async def _handle_reg_lvl(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    context.user_data["registration"].level = payload
+    await safe_edit_message(update.callback_query.message, "Select House:", reply_markup=HOUSE_MARKUP)
 
-    # VIEWS
-    if data.startswith("view_lvl_"):
-        await send_level_selection_menu(update, context, data.split("_")[-1])
-        return
-    if data == "toggle_status_level":
-        kb = [[InlineKeyboardButton(l, callback_data=f"status_view_{l}") for l in ["9", "17"]]]
-        # Use safe_edit_message to catch "Message Not Modified" here
-        await safe_edit_message(query.message, "Select Level to View:", reply_markup=InlineKeyboardMarkup(kb))
-        return
-    if data.startswith("status_view_"):
-        lvl = data.split("_")[-1]
-        machines = services.get_machines_by_level(lvl)
-        await send_status_text(update, context, machines, lvl)
-        return
+async def _handle_reg_house(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    user = update.effective_user
+    house = payload
+    reg = context.user_data["registration"]
+    new_user = services.UserInfo(
+        id=user.id, username=user.username or "", first_name=user.first_name or "",
+        display_name=reg.name, level=reg.level, house=house
+    )
+    await services.run_db(services.create_user, new_user)
+    _USER_CACHE.pop(user.id, None)
+    await safe_edit_message(update.callback_query.message, "✅ Registered! Type /start to begin.")
+    del context.user_data["registration"]
+
+# VIEWS
+async def _handle_view_lvl(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    await send_level_selection_menu(update, context, payload)
+
+async def _handle_toggle_status_level(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    # Use safe_edit_message to catch "Message Not Modified" here
+    await safe_edit_message(update.callback_query.message, "Select Level to View:", reply_markup=STATUS_LEVEL_MARKUP)
+
+async def _handle_status_view(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    lvl = payload
+    machines = await services.get_machines_by_level_async(lvl)
+    await send_status_text(update, context, machines, lvl)
+
+async def _write_with_reply(message, write, text: str, error_text: str) -> bool:
+    """Sends the success reply while the DB write runs; corrects it if the write failed.
+
+    Returns whether the write succeeded, regardless of whether the reply could be edited.
+    """
+    # The reply doesn't depend on the write, so send it while the row is updated
+    wrote, edited = await asyncio.gather(write, safe_edit_message(message, text), return_exceptions=True)
+    if isinstance(wrote, Exception):
+        logger.error(f"❌ Machine update failed: {wrote}")
+        await safe_edit_message(message, error_text)
+        return False
+    if isinstance(edited, Exception):
+        # The row is written either way, so a failed reply must not undo what follows from it
+        logger.warning(f"⚠️ Couldn't edit reply after machine update: {edited}")
+    return True
+
+# MACHINE SELECTION
+async def _handle_sel(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    mid = payload
+    await show_machine_control_panel(update, context, mid)
+
+# SET TIMER
+async def _handle_set(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    user = update.effective_user
+    # Payload is <mid>_<mins>: split the minutes off the end
+    mid, _, mins_s = payload.rpartition("_")
+    mins = int(mins_s)
+    end_time = datetime.datetime.now(_UTC) + datetime.timedelta(minutes=mins)
+
+    started = await _write_with_reply(
+        update.callback_query.message,
+        services.run_db(services.update_machine_status, mid, "Running", end_time, user.id, duration_minutes=mins),
+        f"✅ Timer started for {mins} mins on {mid}!\nI'll notify you when it's done.",
+        "❌ Couldn't start the timer. Please try again."
+    )
+    if started:
+        logger.debug("🕒 Scheduling %sm timer for %s", mins, mid)
+        schedule_alarms(mid, user.id, end_time.timestamp())
 
-    # MACHINE SELECTION
-    if data.startswith("sel_"):
-        mid = data.replace("sel_", "")
+# FORCE STOP
+async def _handle_force(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    user = update.effective_user
+    mid = payload
+    # Audit log + reset happen in one RPC; we get back the row as it was before the stop
+    machine = await services.run_db(services.force_stop_and_get, mid, user.id)
+    if not machine:
         await show_machine_control_panel(update, context, mid)
         return
 
-    # SET TIMER
-    if data.startswith("set_"):
-        parts = data.rsplit("_", 1)
-        mid = parts[0].replace("set_", "")
-        mins = int(parts[1])
-        end_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=mins)
-        services.update_machine_status(mid, "Running", end_time, user.id, duration_minutes=mins)
-        
-        if context.job_queue:
-            print(f"🕒 Scheduling {mins}m timer for {mid}")
-            context.job_queue.run_once(alarm_done, mins * 60, chat_id=user.id, data={"mid": mid}, name=f"done_{mid}")
-            if mins > 5:
-                context.job_queue.run_once(alarm_5min, (mins - 5) * 60, chat_id=user.id, data={"mid": mid}, name=f"5min_{mid}")
-        else:
-            print("❌ CRITICAL: No JobQueue found in context! Notifications will FAIL.")
+    if machine.current_user:
+        try:
+            await context.bot.send_message(machine.current_user.id, f"🚨 Your machine {mid} was stopped by {user.first_name}.")
+        except TelegramError: pass  # owner blocked the bot
 
-        await safe_edit_message(query.message, f"✅ Timer started for {mins} mins on {mid}!\nI'll notify you when it's done.")
-        return
+        cancel_alarms(mid)
 
-    # FORCE STOP
-    if data.startswith("force_"):
-        mid = data.replace("force_", "")
-        machine = services.get_machine(mid)
-        if machine.current_user:
-            services.log_audit_event("FORCE_STOP", mid, machine.current_user.id, user.id)
-            try:
-                await context.bot.send_message(machine.current_user.id, f"🚨 Your machine {mid} was stopped by {user.first_name}.")
-            except: pass
-            
-            if context.job_queue:
-                for job in context.job_queue.get_jobs_by_name(f"done_{mid}"): job.schedule_removal()
-                for job in context.job_queue.get_jobs_by_name(f"5min_{mid}"): job.schedule_removal()
+    # Same state reset_machine_status writes, so the panel needs no re-fetch
+    stopped = machine.model_copy(update={"status": "Finished", "current_user": None})
+    await show_machine_control_panel(update, context, mid, machine=stopped)
 
-        services.reset_machine_status(mid)
-        await show_machine_control_panel(update, context, mid)
+# STOP OWN LAUNDRY - Show confirmation
+async def _handle_stop_own(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    query = update.callback_query
+    user = update.effective_user
+    mid = payload
+    machine = await services.get_machine_async(mid)
+
+    # Safety check: verify user is the owner
+    if not machine.current_user or machine.current_user.id != user.id:
+        await safe_edit_message(query.message, "❌ You are not the owner of this machine.")
         return
 
-    # STOP OWN LAUNDRY - Show confirmation
-    if data.startswith("stop_own_"):
-        mid = data.replace("stop_own_", "")
-        machine = services.get_machine(mid)
-
-        # Safety check: verify user is the owner
-        if not machine.current_user or machine.current_user.id != user.id:
-            await safe_edit_message(query.message, "❌ You are not the owner of this machine.")
-            return
-
-        text = "⚠️ *Are you sure you want to stop your laundry?*\n\nThis will cancel your timer immediately."
-        kb = [
-            [InlineKeyboardButton("✅ Yes, Stop Now", callback_data=f"confirm_stop_{mid}")],
-            [InlineKeyboardButton("❌ Cancel", callback_data=f"sel_{mid}")]
-        ]
-        await safe_edit_message(query.message, text, reply_markup=InlineKeyboardMarkup(kb))
+    text = "⚠️ *Are you sure you want to stop your laundry?*\n\nThis will cancel your timer immediately."
+    kb = [
+        [InlineKeyboardButton("✅ Yes, Stop Now", callback_data=f"confirm_stop_{mid}")],
+        [InlineKeyboardButton("❌ Cancel", callback_data=f"sel_{mid}")]
+    ]
+    await safe_edit_message(query.message, text, reply_markup=InlineKeyboardMarkup(kb))
+
+# CONFIRM STOP - Execute the stop
+async def _handle_confirm_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    query = update.callback_query
+    user = update.effective_user
+    mid = payload
+    machine = await services.get_machine_async(mid)
+
+    # Safety check again
+    if not machine.current_user or machine.current_user.id != user.id:
+        await query.answer()
+        await safe_edit_message(query.message, "❌ You are not the owner of this machine.")
         return
 
-    # CONFIRM STOP - Execute the stop
-    if data.startswith("confirm_stop_"):
-        mid = data.replace("confirm_stop_", "")
-        machine = services.get_machine(mid)
+    # Save level before clearing machine data
+    level = machine.level
 
-        # Safety check again
-        if not machine.current_user or machine.current_user.id != user.id:
-            await safe_edit_message(query.message, "❌ You are not the owner of this machine.")
-            return
+    # Cancel scheduled alarms
+    cancel_alarms(mid)
 
-        # Save level before clearing machine data
-        level = machine.level
+    # Make machine available (user is taking clothes out now)
+    await services.run_db(services.make_machine_available, mid)
 
-        # Cancel scheduled alarms
-        if context.job_queue:
-            for job in context.job_queue.get_jobs_by_name(f"done_{mid}"):
-                job.schedule_removal()
-            for job in context.job_queue.get_jobs_by_name(f"5min_{mid}"):
-                job.schedule_removal()
+    # Show success and return to machine selection menu
+    await query.answer("✅ Laundry stopped successfully!")
+    await send_level_selection_menu(update, context, level)
 
-        # Make machine available (user is taking clothes out now)
-        services.make_machine_available(mid)
+# PING OWNER
+async def _handle_ping(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    query = update.callback_query
+    mid = payload
+    display_name = format_machine_name(mid)
 
-        # Show success and return to machine selection menu
-        await query.answer("✅ Laundry stopped successfully!")
-        await send_level_selection_menu(update, context, level)
+    # Fast path: a ping from this process is still cooling down, no need to read the machine
+    pinged_at = _RECENT_PINGS.get(mid)
+    if pinged_at is not None:
+        remaining = PING_COOLDOWN - int(time.time() - pinged_at)
+        await query.answer(f"⏳ Cooldown! Wait {remaining}s.", show_alert=True)
+        return
+    
+    machine = await services.get_machine_async(mid)
+    last_time = machine.last_ping
+    now_utc = datetime.datetime.now(_UTC)
+    
+    if last_time and (now_utc - last_time).total_seconds() < PING_COOLDOWN:
+        remaining = PING_COOLDOWN - int((now_utc - last_time).total_seconds())
+        await query.answer(f"⏳ Cooldown! Wait {remaining}s.", show_alert=True)
         return
-
-    # PING OWNER
-    if data.startswith("ping_"):
-        mid = data.replace("ping_", "")
-        display_name = format_machine_name(mid)
-        
-        machine = services.get_machine(mid)
-        last_time = machine.last_ping
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
         
-        if last_time and (now_utc - last_time).total_seconds() < 200:
-            remaining = 200 - int((now_utc - last_time).total_seconds())
-            await query.answer(f"⏳ Cooldown! Wait {remaining}s.", show_alert=True)
-            return
-            
-        ping_msg = "✅ Ping Sent!"
-        if machine.last_user:
-            try:
-                await context.bot.send_message(
-                    chat_id=machine.last_user.id,
-                    text=f"🔔 *PING!*\nSomeone is waiting for *{display_name}*. Please collect your laundry immediately!"
-                )
-                await query.answer("🔔 Ping sent!", show_alert=True)
-                
-                services.register_ping(mid)
-                
-                u = machine.last_user
-                handle = escape_md(f" (@{u.username})") if u.username else ""
-                clean_name = escape_md(u.display_name)
-                clean_house = escape_md(u.house)
-                ping_msg = f"✅ Ping sent to *{clean_name}* ({clean_house}){handle}!"
-                
-            except:
-                ping_msg = "❌ Failed to Ping (User Blocked Bot)"
-                await query.answer("❌ Could not reach user.", show_alert=True)
+    ping_msg = "✅ Ping Sent!"
+    if machine.last_user:
+        try:
+            await context.bot.send_message(
+                chat_id=machine.last_user.id,
+                text=f"🔔 *PING!*\nSomeone is waiting for *{display_name}*. Please collect your laundry immediately!"
+            )
+        except TelegramError:
+            ping_msg = "❌ Failed to Ping (User Blocked Bot)"
+            await query.answer("❌ Could not reach user.", show_alert=True)
         else:
-             await query.answer("❌ No user history.", show_alert=True)
-        
-        await show_machine_control_panel(update, context, mid, ping_status=ping_msg)
-        return
+            await query.answer("🔔 Ping sent!", show_alert=True)
+            
+            await services.run_db(services.register_ping, mid)
+            _RECENT_PINGS[mid] = now_utc.timestamp()
+            machine = machine.model_copy(update={"last_ping": now_utc})
+            
+            u = machine.last_user
+            handle = f" (@{escape_md(u.username)})" if u.username else ""
+            clean_name = escape_md(u.display_name)
+            clean_house = escape_md(u.house)
+            ping_msg = f"✅ Ping sent to *{clean_name}* ({clean_house}){handle}!"
+    else:
+         await query.answer("❌ No user history.", show_alert=True)
+    
+    await show_machine_control_panel(update, context, mid, ping_status=ping_msg, machine=machine)
+
+# COLLECT (I'M DONE)
+async def _handle_collect(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    mid = payload
+    await _write_with_reply(
+        update.callback_query.message,
+        services.run_db(services.make_machine_available, mid),
+        f"✅ Machine {mid} marked as Available.\nThank you for collecting your laundry!",
+        f"❌ Couldn't mark {mid} as Available. Please try again."
+    )
 
-    # COLLECT (I'M DONE)
-    if data.startswith("collect_"):
-        mid = data.replace("collect_", "")
-        services.make_machine_available(mid)
-        await safe_edit_message(query.message, f"✅ Machine {mid} marked as Available.\nThank you for collecting your laundry!")
-        return
+# --- COMPLAIN HANDLERS ---
+# Switch level in complain menu
+async def _handle_complain_lvl(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    await send_complain_menu(update, context, payload)
 
-    # --- COMPLAIN HANDLERS ---
-    # Switch level in complain menu
-    if data.startswith("complain_lvl_"):
-        level = data.replace("complain_lvl_", "")
-        await send_complain_menu(update, context, level)
-        return
+# Select machine to report
+async def _handle_complain_sel(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    query = update.callback_query
+    user = update.effective_user
+    mid = payload
+    machine = await services.get_machine_async(mid)
+    display_name = format_machine_name(mid)
 
-    # Select machine to report
-    if data.startswith("complain_sel_"):
-        mid = data.replace("complain_sel_", "")
-        machine = services.get_machine(mid)
-        display_name = format_machine_name(mid)
-
-        # Check rate limit
-        if not services.can_submit_complaint(user.id, mid):
-            await query.answer("⏳ You already reported this machine recently. Please wait.", show_alert=True)
-            return
-
-        # Show confirmation screen
-        level = mid.split("_")[0]
-        status_text = machine.status if machine else "Unknown"
-        text = (f"⚠️ *Confirm Report*\n\n"
-                f"Machine: *{display_name}*\n"
-                f"Current Status: [{status_text}]\n\n"
-                f"Are you sure this machine is actually IN USE by someone not using the bot?")
-        kb = [
-            [InlineKeyboardButton("✅ Confirm Report", callback_data=f"complain_confirm_{mid}")],
-            [InlineKeyboardButton("⬅️ Back", callback_data=f"complain_back_{level}")]
-        ]
-        await safe_edit_message(query.message, text, reply_markup=InlineKeyboardMarkup(kb))
+    # Check rate limit
+    if not await _can_submit_complaint(user.id, mid):
+        await query.answer("⏳ You already reported this machine recently. Please wait.", show_alert=True)
         return
+    await query.answer()
 
-    # Confirm and submit complaint
-    if data.startswith("complain_confirm_"):
-        mid = data.replace("complain_confirm_", "")
-        machine = services.get_machine(mid)
-        display_name = format_machine_name(mid)
-
-        # Double-check rate limit
-        if not services.can_submit_complaint(user.id, mid):
-            await query.answer("⏳ You already reported this machine recently.", show_alert=True)
-            return
-
-        # Log the complaint
-        reported_status = machine.status if machine else "Unknown"
-        services.log_complaint(user.id, mid, reported_status)
-
-        await safe_edit_message(
-            query.message,
-            f"✅ *Thank you for reporting!*\n\n"
-            f"We've logged that *{display_name}* shows as [{reported_status}] but is actually in use.\n\n"
-            f"This helps us track bot adoption. 📊"
-        )
+    # Show confirmation screen
+    level = mid.partition("_")[0]
+    status_text = machine.status if machine else "Unknown"
+    text = (f"⚠️ *Confirm Report*\n\n"
+            f"Machine: *{display_name}*\n"
+            f"Current Status: [{status_text}]\n\n"
+            f"Are you sure this machine is actually IN USE by someone not using the bot?")
+    kb = [
+        [InlineKeyboardButton("✅ Confirm Report", callback_data=f"complain_confirm_{mid}")],
+        [InlineKeyboardButton("⬅️ Back", callback_data=f"complain_back_{level}")]
+    ]
+    await safe_edit_message(query.message, text, reply_markup=InlineKeyboardMarkup(kb))
+
+# Confirm and submit complaint
+async def _handle_complain_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    query = update.callback_query
+    user = update.effective_user
+    mid = payload
+    machine = await services.get_machine_async(mid)
+    display_name = format_machine_name(mid)
+
+    # Double-check rate limit
+    if not await _can_submit_complaint(user.id, mid):
+        await query.answer("⏳ You already reported this machine recently.", show_alert=True)
         return
+    await query.answer()
+
+    # Log the complaint
+    reported_status = machine.status if machine else "Unknown"
+    services.log_complaint(user.id, mid, reported_status)
+    _RECENT_COMPLAINTS[(user.id, mid)] = time.time()
+
+    await safe_edit_message(
+        query.message,
+        f"✅ *Thank you for reporting!*\n\n"
+        f"We've logged that *{display_name}* shows as [{reported_status}] but is actually in use.\n\n"
+        f"This helps us track bot adoption. 📊"
+    )
+
+# Go back to complain menu
+async def _handle_complain_back(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    await send_complain_menu(update, context, payload)
+
+# Callback data that must match exactly
+_EXACT_DISPATCH = {
+    "ignore_ping": _handle_ignore_ping,
+    "toggle_status_level": _handle_toggle_status_level,
+}
+
+# Routes keyed on the callback prefix (one or two words, without the trailing underscore).
+# No one-word key is the first word of a two-word key, so the split in button_handler is unambiguous.
+_DISPATCH = {
+    "sel": _handle_sel,
+    "set": _handle_set,
+    "force": _handle_force,
+    "ping": _handle_ping,
+    "collect": _handle_collect,
+    "reg_lvl": _handle_reg_lvl,
+    "reg_house": _handle_reg_house,
+    "view_lvl": _handle_view_lvl,
+    "status_view": _handle_status_view,
+    "stop_own": _handle_stop_own,
+    "confirm_stop": _handle_confirm_stop,
+    "complain_lvl": _handle_complain_lvl,
+    "complain_sel": _handle_complain_sel,
+    "complain_confirm": _handle_complain_confirm,
+    "complain_back": _handle_complain_back,
+}
+
+# Handlers that answer the callback query themselves, on every path. Telegram accepts one
+# answer per query, so button_handler must not send its blanket ack for these.
+_SELF_ANSWERING = {
+    _handle_ignore_ping,
+    _handle_confirm_stop,
+    _handle_ping,
+    _handle_complain_sel,
+    _handle_complain_confirm,
+}
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
 
-    # Go back to complain menu
-    if data.startswith("complain_back_"):
-        level = data.replace("complain_back_", "")
-        await send_complain_menu(update, context, level)
-        return
\ No newline at end of file
+    handler = _EXACT_DISPATCH.get(data)
+    payload = data
+    if handler is None:
+        # Handlers receive only the payload after the prefix (a machine id, level, house, ...)
+        head, _, payload = data.partition("_")
+        handler = _DISPATCH.get(head)
+        if handler is None:
+            second, _, payload = payload.partition("_")
+            handler = _DISPATCH.get(f"{head}_{second}")
+
+    if handler not in _SELF_ANSWERING:
+        # Stop the client's spinner in the background so the ack overlaps the actual work
+        context.application.create_task(query.answer(), update=update)
+    if handler:
+        return await handler(update, context, payload)
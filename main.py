@@ -1,18 +1,41 @@
+import asyncio
 import logging
 from fastapi import FastAPI, Request
 from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 )
+from telegram.request import HTTPXRequest
 import config
 import handlers
+import services
 
 # Logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
 # FastAPI
 app = FastAPI()
-ptb_app = Application.builder().token(config.TOKEN).build() if config.TOKEN else None
+# One pooled HTTP/2 connection to api.telegram.org shared by every handler's replies/edits
+ptb_app = Application.builder().token(config.TOKEN).request(
+    HTTPXRequest(connection_pool_size=32, http_version="2", connect_timeout=5, read_timeout=5)
+).build() if config.TOKEN else None
+
+# Long-running background tasks (log write batching, alarm timers); referenced so they aren't GC'd
+background_tasks = []
+
+def start_background_tasks(application):
+    loop = asyncio.get_running_loop()
+    background_tasks.append(loop.create_task(services.run_write_queue()))
+    background_tasks.append(loop.create_task(handlers.run_timer_loop(application.bot)))
+
+# Webhook updates being processed in the background
+MAX_INFLIGHT_UPDATES = 100
+_INFLIGHT = asyncio.Semaphore(MAX_INFLIGHT_UPDATES)
+_inflight_tasks = set()
+
+def _update_done(task):
+    _inflight_tasks.discard(task)
+    _INFLIGHT.release()
 
 def register_handlers(application):
     application.add_handler(CommandHandler("start", handlers.start_command))
@@ -30,16 +53,32 @@ async def startup_event():
         register_handlers(ptb_app)
         await ptb_app.initialize()
         await ptb_app.start()
+        start_background_tasks(ptb_app)
         await handlers.set_bot_commands(ptb_app)
         # --- RESTORE TIMERS FROM DB ---
         await handlers.restore_timers(ptb_app)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if ptb_app:
+        # These updates were already acknowledged, so Telegram won't resend them: finish them first
+        await asyncio.gather(*_inflight_tasks, return_exceptions=True)
+        await ptb_app.stop()
+        await ptb_app.shutdown()
+    # Queued log rows (audit, complaints) only live in memory; write them before exiting
+    await services.flush_write_queue()
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     if not ptb_app: return {"status": "error"}
-    req = await request.json()
+    req = config.json_loads(await request.body())
     update = Update.de_json(req, ptb_app.bot)
-    await ptb_app.process_update(update)
+    # Telegram only needs the 200; handle the update after replying. Past MAX_INFLIGHT_UPDATES
+    # the webhook waits for a slot instead, so a burst can't spawn unbounded work.
+    await _INFLIGHT.acquire()
+    task = asyncio.create_task(ptb_app.process_update(update))
+    _inflight_tasks.add(task)
+    task.add_done_callback(_update_done)
     return {"status": "ok"}
 
 # --- NEW: HEALTH CHECK ENDPOINT ---
@@ -55,8 +94,13 @@ if __name__ == "__main__":
         register_handlers(ptb_app)
         
         async def post_init(app):
+            start_background_tasks(app)
             await handlers.set_bot_commands(app)
             await handlers.restore_timers(app)
             
+        async def post_shutdown(app):
+            await services.flush_write_queue()
+
         ptb_app.post_init = post_init
+        ptb_app.post_shutdown = post_shutdown
         ptb_app.run_polling()
\ No newline at end of file
@@ -1,15 +1,45 @@
+import asyncio
 import datetime
+import functools
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List, Dict, Any
-from supabase import create_client, Client
-from pydantic import BaseModel
-import pytz
+from zoneinfo import ZoneInfo
+import httpx
+from supabase import create_client, Client, ClientOptions
+from postgrest import ReturnMethod
+from pydantic import BaseModel, TypeAdapter
 import config
 
+logger = logging.getLogger(__name__)
+
 # Singapore timezone for usage tracking
-SINGAPORE_TZ = pytz.timezone('Asia/Singapore')
+SINGAPORE_TZ = ZoneInfo('Asia/Singapore')
+_UTC = datetime.timezone.utc
+
+def _iso_now() -> str:
+    """Current time as an explicit-UTC timestamp string for writes to timestamptz columns."""
+    return datetime.datetime.now(_UTC).isoformat(timespec="milliseconds")
+
+# Blocking Supabase calls made from the event loop run on their own bounded pool, so a burst
+# of updates can't pile unbounded requests onto the client or queue up behind chart rendering
+DB_WORKERS = 8
+_DB_EXEC = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
 
 # Initialize Supabase
-supabase: Client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+# postgrest already reuses one HTTP/2 client; this only sizes its pool to the DB workers and tightens the timeouts
+_HTTP = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_connections=DB_WORKERS, max_keepalive_connections=DB_WORKERS, keepalive_expiry=60),
+)
+supabase: Client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY, options=ClientOptions(httpx_client=_HTTP))
+
+async def run_db(fn, *args, **kwargs):
+    """Runs a blocking service call on the DB thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(_DB_EXEC, functools.partial(fn, *args, **kwargs))
 
 # --- MODELS ---
 class UserInfo(BaseModel):
@@ -32,71 +62,168 @@ class MachineState(BaseModel):
     last_ping: Optional[datetime.datetime] = None # Added for persistent cooldown
 
 # --- USER SERVICES ---
+_USER_COLS = "id,username,first_name,display_name,level,house"
 
 def get_user(user_id: int) -> Optional[UserInfo]:
-    response = supabase.table("users").select("*").eq("id", user_id).execute()
+    response = supabase.table("users").select(_USER_COLS).eq("id", user_id).execute()
     if response.data:
         return UserInfo(**response.data[0])
     return None
 
 def create_user(user_info: UserInfo):
     data = user_info.dict(exclude_none=True)
-    supabase.table("users").upsert(data).execute()
+    supabase.table("users").upsert(data, returning=ReturnMethod.minimal).execute()
+    # Cached machine rows embed user profiles, so drop them all
+    _MACHINE_CACHE.clear()
+    _LEVEL_CACHE.clear()
 
 # --- MACHINE SERVICES ---
+# Select lists naming only the columns MachineState/UserInfo read, with the user profiles embedded
+_MACHINE_COLS = "id,type,level,status,start_time,end_time,last_ping"
+_MACHINE_SELECT = (f"{_MACHINE_COLS},current_user:users!current_user_id({_USER_COLS}),"
+                   f"last_user:users!last_user_id({_USER_COLS})")
+_MACHINE_SELECT_CURRENT = f"{_MACHINE_COLS},current_user:users!current_user_id({_USER_COLS})"
+# Level views only render names, so they embed just the user columns UserInfo requires
+_LEVEL_SELECT = (f"{_MACHINE_COLS},current_user:users!current_user_id(id,username,first_name,display_name),"
+                 "last_user:users!last_user_id(id,username,first_name,display_name)")
 
-def get_machines_by_level(level: str) -> List[MachineState]:
-    query = supabase.table("machines").select(
-        "*, current_user:users!current_user_id(*), last_user:users!last_user_id(*)"
-    ).eq("level", level).order("id")
+# get_machine cache: (write generation, monotonic read time, raw row) per machine.
+# Rows (not models) are kept so the lazy Running -> Finished flip is re-evaluated on every hit.
+# Our own writes bump the generation; the TTL bounds staleness from edits made elsewhere
+# (the Supabase dashboard, another instance during a deploy).
+MACHINE_CACHE_TTL = 5.0
+_MACHINE_CACHE: Dict[str, tuple[int, float, Dict]] = {}
+_MACHINE_GEN: Dict[str, int] = defaultdict(int)
+
+# get_machines_by_level cache: (monotonic read time, raw rows) per level.
+# Absorbs bursts of menu/status button presses; any write to a machine on the level drops it.
+LEVEL_CACHE_TTL = 5.0
+_LEVEL_CACHE: Dict[str, tuple[float, List[Dict]]] = {}
+_LEVEL_GEN: Dict[str, int] = defaultdict(int)  # so a read racing a write isn't cached
+
+def _bump_machine(machine_id: str):
+    # Called after every write to a machine row so cached reads of it are discarded
+    _MACHINE_GEN[machine_id] += 1
+    level = machine_id.partition("_")[0]
+    _LEVEL_GEN[level] += 1
+    _LEVEL_CACHE.pop(level, None)
+
+# Each cached read is split into a cache lookup and a fetch, so the async variants can answer
+# hits inline on the event loop and only send misses to the DB thread pool.
+# Concurrent misses for the same key share one fetch. Keys include the write generation,
+# so a caller arriving after a write never joins a fetch that started before it.
+_IN_FLIGHT: Dict[tuple, asyncio.Future] = {}
+
+async def _fetch_once(key: tuple, fn, *args):
+    fut = _IN_FLIGHT.get(key)
+    if fut is None:
+        fut = _IN_FLIGHT[key] = asyncio.ensure_future(run_db(fn, *args))
+        fut.add_done_callback(lambda _: _IN_FLIGHT.pop(key, None))
+    # Shielded so one cancelled caller doesn't cancel the fetch for the others
+    return await asyncio.shield(fut)
+
+def _cached_level(level: str) -> Optional[List[MachineState]]:
+    cached = _LEVEL_CACHE.get(level)
+    if cached and time.monotonic() - cached[0] < LEVEL_CACHE_TTL:
+        return _parse_machines(cached[1])
+    return None
+
+def _fetch_level(level: str) -> List[MachineState]:
+    now = time.monotonic()
+    gen = _LEVEL_GEN.get(level, 0)
+    query = supabase.table("machines").select(_LEVEL_SELECT).eq("level", level).order("id")
     
     response = query.execute()
+    # Levels come from callback data: only cache ones that exist, so junk levels can't pile up
+    if response.data and gen == _LEVEL_GEN.get(level, 0):
+        _LEVEL_CACHE[level] = (now, response.data)
     return _parse_machines(response.data)
 
-def get_machine(machine_id: str) -> Optional[MachineState]:
-    query = supabase.table("machines").select(
-        "*, current_user:users!current_user_id(*), last_user:users!last_user_id(*)"
-    ).eq("id", machine_id)
+def get_machines_by_level(level: str) -> List[MachineState]:
+    machines = _cached_level(level)
+    return machines if machines is not None else _fetch_level(level)
+
+async def get_machines_by_level_async(level: str) -> List[MachineState]:
+    machines = _cached_level(level)
+    if machines is None:
+        machines = await _fetch_once(("level", level, _LEVEL_GEN.get(level, 0)), _fetch_level, level)
+    return machines
+
+def _cached_machine(machine_id: str) -> Optional[MachineState]:
+    cached = _MACHINE_CACHE.get(machine_id)
+    if cached and cached[0] == _MACHINE_GEN.get(machine_id, 0) and time.monotonic() - cached[1] < MACHINE_CACHE_TTL:
+        return _parse_machines([cached[2]])[0]
+    return None
+
+def _fetch_machine(machine_id: str) -> Optional[MachineState]:
+    now = time.monotonic()
+    gen = _MACHINE_GEN.get(machine_id, 0)
+    query = supabase.table("machines").select(_MACHINE_SELECT).eq("id", machine_id)
     
     response = query.execute()
     if response.data:
+        _MACHINE_CACHE[machine_id] = (gen, now, response.data[0])
         return _parse_machines(response.data)[0]
     return None
 
+def get_machine(machine_id: str) -> Optional[MachineState]:
+    return _cached_machine(machine_id) or _fetch_machine(machine_id)
+
+async def get_machine_async(machine_id: str) -> Optional[MachineState]:
+    return _cached_machine(machine_id) or await _fetch_once(
+        ("machine", machine_id, _MACHINE_GEN.get(machine_id, 0)), _fetch_machine, machine_id)
+
 def get_running_machines() -> List[MachineState]:
     """Fetches ONLY machines that are currently marked as Running."""
-    query = supabase.table("machines").select(
-        "*, current_user:users!current_user_id(*)"
-    ).eq("status", "Running")
+    query = supabase.table("machines").select(_MACHINE_SELECT_CURRENT).eq("status", "Running")
     
     response = query.execute()
     return _parse_machines(response.data)
 
 def update_machine_status(machine_id: str, status: str, end_time: datetime.datetime, user_id: int, duration_minutes: int = 0):
-    # Update machine state
-    supabase.table("machines").update({
-        "status": status,
-        "start_time": datetime.datetime.now().isoformat(),
-        "end_time": end_time.isoformat(),
-        "current_user_id": user_id,
-        "last_user_id": user_id,
-        "last_ping": None # Reset ping when new cycle starts
-    }).eq("id", machine_id).execute()
-
-    # Log usage event for peak period tracking
     if status == "Running" and duration_minutes > 0:
-        level = machine_id.split("_")[0]  # Extract level from machine_id (e.g., "9_washer_1" -> "9")
-        try:
-            log_usage_event(machine_id, user_id, level, duration_minutes)
-        except Exception as e:
-            print(f"⚠️ Failed to log usage event: {e}")
+        # Cycle start: the machine update and its usage event (for peak period tracking)
+        # are written in one transaction by the start_cycle SQL function
+        supabase.rpc("start_cycle", {
+            "p_machine_id": machine_id,
+            "p_user_id": user_id,
+            "p_end_time": end_time.isoformat(),
+            **_usage_fields(machine_id, duration_minutes)
+        }).execute()
+    else:
+        # Update machine state
+        supabase.table("machines").update({
+            "status": status,
+            "start_time": _iso_now(),
+            "end_time": end_time.isoformat(),
+            "current_user_id": user_id,
+            "last_user_id": user_id,
+            "last_ping": None # Reset ping when new cycle starts
+        }, returning=ReturnMethod.minimal).eq("id", machine_id).execute()
+    _bump_machine(machine_id)
+
+def force_stop_and_get(machine_id: str, actor_id: int) -> Optional[MachineState]:
+    """Force-stops a machine in one round-trip (see the force_stop_and_get SQL function).
+
+    Returns the row as it was BEFORE the stop, so callers still know whose laundry was interrupted.
+    The FORCE_STOP audit event is written by the function when the machine had a current user.
+    """
+    response = supabase.rpc("force_stop_and_get", {
+        "p_machine_id": machine_id,
+        "p_actor_id": actor_id
+    }).select(_MACHINE_SELECT).execute()
+    _bump_machine(machine_id)
+    if response.data:
+        return _parse_machines(response.data)[0]
+    return None
 
 def reset_machine_status(machine_id: str):
     # Used when force stopping or marking as finished
     supabase.table("machines").update({
         "status": "Finished",
         "current_user_id": None # Remove current user ownership
-    }).eq("id", machine_id).execute()
+    }, returning=ReturnMethod.minimal).eq("id", machine_id).execute()
+    _bump_machine(machine_id)
 
 def make_machine_available(machine_id: str):
     # Used when user collects laundry
@@ -106,98 +233,158 @@ def make_machine_available(machine_id: str):
         "start_time": None,
         "end_time": None,
         "last_ping": None # Clear ping history
-    }).eq("id", machine_id).execute()
+    }, returning=ReturnMethod.minimal).eq("id", machine_id).execute()
+    _bump_machine(machine_id)
 
 def register_ping(machine_id: str):
     # Updates the last_ping timestamp to NOW
     supabase.table("machines").update({
-        "last_ping": datetime.datetime.now().isoformat()
-    }).eq("id", machine_id).execute()
+        "last_ping": _iso_now()
+    }, returning=ReturnMethod.minimal).eq("id", machine_id).execute()
+    _bump_machine(machine_id)
 
 def log_audit_event(event: str, machine_id: str, victim_id: int, offender_id: int):
-    supabase.table("audit_logs").insert({
+    _insert_later("audit_logs", {
         "event": event,
         "machine_id": machine_id,
         "victim_id": victim_id,
         "offender_id": offender_id
-    }).execute()
+    })
 
 # --- HELPER ---
+# Validates a whole result set in one pydantic-core call; extra columns (the *_user_id keys) are ignored
+_MACHINE_LIST = TypeAdapter(List[MachineState])
+
+# UserInfo models by field values: the same few users recur across rows and refreshes, so
+# their embeds are validated once. A changed profile is just a new key, so nothing goes stale.
+USER_MODEL_CACHE_SIZE = 1024
+_USER_MODELS: Dict[tuple, UserInfo] = {}
+
+def _user_model(u: Dict) -> UserInfo:
+    key = (u.get('id'), u.get('username'), u.get('first_name'), u.get('display_name'), u.get('level'), u.get('house'))
+    user = _USER_MODELS.get(key)
+    if user is None:
+        if len(_USER_MODELS) >= USER_MODEL_CACHE_SIZE:
+            _USER_MODELS.clear()
+        user = _USER_MODELS[key] = UserInfo(**u)
+    return user
+
 def _parse_machines(data: List[Dict]) -> List[MachineState]:
-    results = []
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
+    rows = []
     for row in data:
-        current_u = UserInfo(**row['current_user']) if row.get('current_user') else None
-        last_u = UserInfo(**row['last_user']) if row.get('last_user') else None
-        
-        end_dt = None
-        if row.get('end_time'):
-            end_dt = datetime.datetime.fromisoformat(row['end_time'].replace('Z', '+00:00'))
-
-        ping_dt = None
-        if row.get('last_ping'):
-            ping_dt = datetime.datetime.fromisoformat(row['last_ping'].replace('Z', '+00:00'))
-
-        status = row['status']
-        if status == 'Running' and end_dt and end_dt < now:
-            status = 'Finished'
-            
-        m = MachineState(
-            id=row['id'],
-            type=row['type'],
-            level=row['level'],
-            status=status,
-            start_time=row.get('start_time'),
-            end_time=end_dt,
-            current_user=current_u,
-            last_user=last_u,
-            last_ping=ping_dt
-        )
-        results.append(m)
-    return results
+        cu, lu = row.get('current_user'), row.get('last_user')
+        if cu or lu:
+            # Copy rather than mutate: the caches hold these raw rows
+            row = {**row, 'current_user': _user_model(cu) if cu else None, 'last_user': _user_model(lu) if lu else None}
+        rows.append(row)
+    machines = _MACHINE_LIST.validate_python(rows)
+    now = datetime.datetime.now(_UTC)
+    for m in machines:
+        # Lazy finish: a Running cycle past its end time reads as Finished
+        if m.status == 'Running' and m.end_time and m.end_time < now:
+            m.status = 'Finished'
+    return machines
 
 # --- USAGE EVENT LOGGING (for peak period tracking) ---
 
-def log_usage_event(machine_id: str, user_id: int, level: str, duration_minutes: int):
-    """Log a machine start event for peak period analytics."""
+def _usage_fields(machine_id: str, duration_minutes: int) -> Dict[str, Any]:
+    """start_cycle's usage-event parameters; hour and weekday are in Singapore time."""
     now = datetime.datetime.now(SINGAPORE_TZ)
-    supabase.table("machine_usage_events").insert({
-        "machine_id": machine_id,
-        "user_id": user_id,
-        "level": level,
-        "duration_minutes": duration_minutes,
-        "hour_of_day": now.hour,
-        "day_of_week": now.weekday()  # 0=Monday, 6=Sunday
-    }).execute()
-
-def get_hourly_usage_data(level: str, days_back: int = 30) -> List[Dict]:
-    """Fetch usage events for the past N days for a specific level."""
-    cutoff = (datetime.datetime.now() - datetime.timedelta(days=days_back)).isoformat()
-    response = supabase.table("machine_usage_events") \
-        .select("hour_of_day, day_of_week, machine_id, created_at") \
-        .eq("level", level) \
-        .gte("created_at", cutoff) \
-        .execute()
+    return {
+        "p_level": machine_id.partition("_")[0],  # "9_washer_1" -> "9"
+        "p_duration_minutes": duration_minutes,
+        "p_hour_of_day": now.hour,
+        "p_day_of_week": now.weekday()  # 0=Monday, 6=Sunday
+    }
+
+def get_usage_histogram(level: str, days_back: int = 30) -> List[Dict]:
+    """Usage events for the past N days on a level, counted per (day_of_week, hour_of_day) in Postgres.
+
+    Each row is {day_of_week, hour_of_day, cycles, active_days}; active_days (distinct dates with
+    any usage in the window) is the same on every row.
+    """
+    response = supabase.rpc("usage_histogram", {"p_level": level, "p_days": days_back}).execute()
     return response.data
 
 # --- COMPLAINT SERVICES ---
 
 def can_submit_complaint(user_id: int, machine_id: str) -> bool:
     """Check if user can submit complaint (rate limit: 1 per machine per hour)."""
-    one_hour_ago = (datetime.datetime.now() - datetime.timedelta(hours=1)).isoformat()
+    one_hour_ago = (datetime.datetime.now(_UTC) - datetime.timedelta(hours=1)).isoformat()
     response = supabase.table("complaints") \
         .select("id") \
         .eq("user_id", user_id) \
         .eq("machine_id", machine_id) \
         .gte("created_at", one_hour_ago) \
+        .limit(1) \
         .execute()
-    return len(response.data) == 0
+    return not response.data
 
 def log_complaint(user_id: int, machine_id: str, reported_status: str):
     """Log a machine discrepancy complaint."""
-    supabase.table("complaints").insert({
+    _insert_later("complaints", {
         "user_id": user_id,
         "machine_id": machine_id,
         "reported_status": reported_status
-    }).execute()
\ No newline at end of file
+    })
+
+# --- BACKGROUND WRITES ---
+# Append-only log rows (audit, complaints) are queued and inserted in batches by
+# run_write_queue, so handlers don't wait on a Supabase round-trip for them.
+WRITE_BATCH_SIZE = 20
+WRITE_BATCH_WINDOW = 0.05  # seconds to let a batch fill up after the first row arrives
+_WRITE_QUEUE: asyncio.Queue = asyncio.Queue()
+_WRITER_RUNNING = False
+
+def _insert_later(table: str, row: Dict[str, Any]):
+    if _WRITER_RUNNING:
+        _WRITE_QUEUE.put_nowait((table, row))
+    else:
+        # No writer task (e.g. a one-off script): write through immediately
+        supabase.table(table).insert(row, returning=ReturnMethod.minimal).execute()
+
+def _bulk_insert(table: str, rows: List[Dict[str, Any]]):
+    supabase.table(table).insert(rows, returning=ReturnMethod.minimal).execute()
+
+def _by_table(items: List[tuple[str, Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+    by_table: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for table, row in items:
+        by_table[table].append(row)
+    return by_table
+
+async def run_write_queue():
+    """Drains queued log rows forever, one bulk insert per table per batch."""
+    global _WRITER_RUNNING
+    _WRITER_RUNNING = True
+    try:
+        while True:
+            items = [await _WRITE_QUEUE.get()]
+            await asyncio.sleep(WRITE_BATCH_WINDOW)
+            while len(items) < WRITE_BATCH_SIZE and not _WRITE_QUEUE.empty():
+                items.append(_WRITE_QUEUE.get_nowait())
+
+            for table, rows in _by_table(items).items():
+                try:
+                    await run_db(_bulk_insert, table, rows)
+                except Exception as e:
+                    logger.error(f"⚠️ Failed to write {len(rows)} row(s) to {table}: {e}")
+            for _ in items:
+                _WRITE_QUEUE.task_done()
+    finally:
+        _WRITER_RUNNING = False
+
+async def flush_write_queue():
+    """Waits until every queued log row is written; run on shutdown so none die with the process."""
+    if _WRITER_RUNNING:
+        await _WRITE_QUEUE.join()
+        return
+    # No writer task left to drain the queue: insert the leftovers directly
+    items = []
+    while not _WRITE_QUEUE.empty():
+        items.append(_WRITE_QUEUE.get_nowait())
+        _WRITE_QUEUE.task_done()
+    for table, rows in _by_table(items).items():
+        try:
+            await run_db(_bulk_insert, table, rows)
+        except Exception as e:
+            logger.error(f"⚠️ Failed to write {len(rows)} row(s) to {table}: {e}")